@@ -7,13 +7,20 @@ email content for Zapier to send.
 Deploy to: Render, Railway, Fly.io, or any ASGI-compatible host.
 """
 
+import asyncio
+import hashlib
+import json
+import operator
 import os
 import re
+import time
 import httpx
-from datetime import datetime
+from datetime import date
 from typing import Optional
+from cachetools import TLRUCache
+from redis import asyncio as aioredis
 from fastapi import FastAPI, HTTPException, Header, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from pydantic import BaseModel, Field
 
 
@@ -31,16 +38,33 @@ RESOURCES_DB_ID = os.environ.get("RESOURCES_DB_ID", "")
 PRACTICE_DB_ID = os.environ.get("PRACTICE_DB_ID", "")
 MISTAKES_DB_ID = os.environ.get("MISTAKES_DB_ID", "")
 
+# Optional Redis for a query cache shared across workers and restarts
+REDIS_URL = os.environ.get("REDIS_URL", "")
+
 NOTION_API_VERSION = "2022-06-28"
 NOTION_BASE_URL = "https://api.notion.com/v1"
 
+# Max in-flight Notion requests (Notion averages ~3 req/s per integration)
+NOTION_MAX_CONCURRENCY = 5
+
+# Max values per compound "or" filter (each value adds two conditions)
+NOTION_MAX_FILTER_VALUES = 50
+
+# In-process cache of query results, so Zapier retries don't re-query Notion
+NOTION_CACHE_SIZE = 512
+NOTION_CACHE_TTL = 300  # seconds
+NOTION_CACHE_PREFIX = "notion:"
+
+# Keep Redis from stalling webhooks if it stops answering
+REDIS_TIMEOUT = 0.5  # seconds
+
 
 # ==============================================================================
 # PYDANTIC MODELS
 # ==============================================================================
 
 class WebhookRequest(BaseModel):
-    run_date: str = Field(..., description="Date in YYYY-MM-DD format")
+    run_date: date = Field(..., description="Date in YYYY-MM-DD format")
     timezone: str = Field(default="America/New_York")
 
 
@@ -81,7 +105,11 @@ def extract_rich_text(prop: dict) -> str:
     if not arr:
         return ""
     
-    return "".join(item.get("plain_text", "") for item in arr).strip()
+    # Single-segment text is the common case; skip the join
+    if len(arr) == 1:
+        return arr[0].get("plain_text", "").strip()
+    
+    return "".join([item.get("plain_text", "") for item in arr]).strip()
 
 
 def extract_select(prop: dict) -> str:
@@ -125,15 +153,89 @@ def extract_url(prop: dict) -> str:
     return ""
 
 
-def get_prop(page: dict, name: str) -> dict:
-    """Safely get a property from a Notion page."""
-    return page.get("properties", {}).get(name, {})
+# Fetch a page's properties dict once, for pages read many properties at a time.
+# A page without properties yields an empty (read-only) dict rather than a KeyError.
+props_of = operator.methodcaller("get", "properties", {})
+
+
+def extract_select_or_text(prop: dict) -> str:
+    """Extract a select name, falling back to plain text for text properties."""
+    return extract_select(prop) or extract_rich_text(prop)
+
+
+PROPERTY_EXTRACTORS = {
+    "rich_text": extract_rich_text,
+    "select": extract_select_or_text,
+    "url": extract_url,
+}
+
+
+def extract_page(page: dict, schema: list[tuple[str, str, str]]) -> dict:
+    """
+    Extract several properties from a page in one pass.
+    Schema entries are (key, property name, extractor type).
+    """
+    props = props_of(page)
+    return {
+        key: PROPERTY_EXTRACTORS[kind](props.get(name, {}))
+        for key, name, kind in schema
+    }
+
+
+def index_pages(pages: list[dict], name: str) -> dict[str, dict]:
+    """
+    Map each page's text ID property to the page.
+    The first page wins on duplicate IDs, matching results[0] of a per-ID query.
+    """
+    index = {}
+    for page in pages:
+        index.setdefault(extract_rich_text(props_of(page).get(name, {})), page)
+    return index
+
+
+# ==============================================================================
+# PAGE SCHEMAS
+# ==============================================================================
+
+OBJECTIVE_SCHEMA = [
+    ("objective", "Objective", "rich_text"),
+    ("exam_area", "Exam Area", "select"),
+    ("skill_group", "Skill Group", "select"),
+    ("priority", "Priority", "select"),
+    ("primary_resources", "Primary Resources (IDs)", "rich_text"),
+]
+
+RESOURCE_SCHEMA = [
+    ("name", "Name", "rich_text"),
+    ("type", "Type", "select"),
+    ("url", "URL", "url"),
+    ("why", "Why it matters", "rich_text"),
+]
+
+PRACTICE_TEST_SCHEMA = [
+    ("provider", "Provider", "select"),
+    ("test", "Test", "rich_text"),
+    ("focus", "Primary Focus", "rich_text"),
+    ("notes", "Notes", "rich_text"),
+]
+
+MISTAKE_SCHEMA = [
+    ("objective_id", "Objective ID", "rich_text"),
+    ("summary", "Mistake Summary", "rich_text"),
+    ("rule", "Correct Rule", "rich_text"),
+    ("tip", "Recognition Tip", "rich_text"),
+]
 
 
 # ==============================================================================
 # ID PARSING UTILITIES
 # ==============================================================================
 
+# Range patterns like P-ENTRA-01..04 and P-ENTRA-01..P-ENTRA-04 in one pass.
+# The repeated prefix is optional and lazy, so the short form wins when both fit.
+RANGE_RE = re.compile(r"(?P<prefix>.+?)(?P<start>\d+)\.\.(?:(?P=prefix))??(?P<end>\d+)")
+
+
 def parse_id_list(raw: str) -> list[str]:
     """
     Parse comma-separated IDs, handling ranges like P-ENTRA-01..04.
@@ -147,28 +249,18 @@ def parse_id_list(raw: str) -> list[str]:
     
     for token in tokens:
         # Check for range pattern like P-ENTRA-01..04 or P-ENTRA-01..P-ENTRA-04
-        range_match = re.match(r"^(.+?)(\d+)\.\.(\d+)$", token)
+        range_match = RANGE_RE.fullmatch(token)
         if range_match:
-            prefix = range_match.group(1)
-            start_num = int(range_match.group(2))
-            end_num = int(range_match.group(3))
-            width = len(range_match.group(2))  # preserve leading zeros
+            prefix = range_match.group("prefix")
+            start_num = int(range_match.group("start"))
+            end_num = int(range_match.group("end"))
+            width = len(range_match.group("start"))  # preserve leading zeros
             for i in range(start_num, end_num + 1):
-                ids.add(f"{prefix}{str(i).zfill(width)}")
+                ids.add(f"{prefix}{i:0{width}d}")
         else:
-            # Also handle P-PREFIX-01..P-PREFIX-04 style
-            range_match2 = re.match(r"^(.+?)(\d+)\.\.(.+?)(\d+)$", token)
-            if range_match2 and range_match2.group(1) == range_match2.group(3):
-                prefix = range_match2.group(1)
-                start_num = int(range_match2.group(2))
-                end_num = int(range_match2.group(4))
-                width = len(range_match2.group(2))
-                for i in range(start_num, end_num + 1):
-                    ids.add(f"{prefix}{str(i).zfill(width)}")
-            else:
-                ids.add(token)
+            ids.add(token)
     
-    return sorted(list(ids))
+    return sorted(ids)
 
 
 # ==============================================================================
@@ -176,31 +268,134 @@ def parse_id_list(raw: str) -> list[str]:
 # ==============================================================================
 
 class NotionClient:
-    def __init__(self, token: str):
-        self.token = token
-        self.headers = {
-            "Authorization": f"Bearer {token}",
-            "Notion-Version": NOTION_API_VERSION,
-            "Content-Type": "application/json"
-        }
+    def __init__(self, client: httpx.AsyncClient, redis: Optional[aioredis.Redis] = None):
+        # Shared client (see startup handler) so connections are kept alive
+        # across queries instead of re-handshaking on every request.
+        self.client = client
+        # Optional second cache tier behind the in-process one
+        self.redis = redis
+        self.semaphore = asyncio.Semaphore(NOTION_MAX_CONCURRENCY)
+        # Entries are (expires_at, results) so a Redis hit keeps its remaining TTL
+        self.cache = TLRUCache(maxsize=NOTION_CACHE_SIZE, ttu=lambda key, entry, now: entry[0])
+        self.cache_locks: dict[tuple, asyncio.Lock] = {}
+        self.cache_lock_users: dict[tuple, int] = {}
     
     async def query_database(
         self, 
         database_id: str, 
         filter_obj: Optional[dict] = None,
-        sorts: Optional[list] = None
+        sorts: Optional[list] = None,
+        page_size: Optional[int] = None
+    ) -> list[dict]:
+        """
+        Query a Notion database with optional filter and sorts.
+        Follows pagination to return all results, unless page_size is given,
+        in which case only the first page of that size is returned.
+        Results are cached for at most NOTION_CACHE_TTL seconds after they were
+        fetched, in process and in Redis when configured.
+        """
+        key = (
+            database_id,
+            json.dumps(filter_obj, sort_keys=True),
+            json.dumps(sorts, sort_keys=True),
+            page_size
+        )
+        
+        cached = self.cache.get(key)
+        if cached is None:
+            # One fetch per key; concurrent callers wait for it instead of
+            # all hitting Notion at once
+            lock = self.cache_locks.setdefault(key, asyncio.Lock())
+            self.cache_lock_users[key] = self.cache_lock_users.get(key, 0) + 1
+            try:
+                async with lock:
+                    cached = self.cache.get(key)
+                    if cached is None:
+                        redis_key = self.redis_key(key)
+                        cached = await self.redis_get(redis_key)
+                        if cached is None:
+                            results = tuple(await self.fetch_database(database_id, filter_obj, sorts, page_size))
+                            cached = (time.monotonic() + NOTION_CACHE_TTL, results)
+                            await self.redis_set(redis_key, results)
+                        self.cache[key] = cached
+            finally:
+                # Drop the lock only once no caller holds or waits on it, so a
+                # new caller can never start a second fetch for the same key
+                self.cache_lock_users[key] -= 1
+                if not self.cache_lock_users[key]:
+                    del self.cache_lock_users[key]
+                    del self.cache_locks[key]
+        
+        return list(cached[1])
+    
+    async def invalidate(self, database_id: str) -> None:
+        """Drop all cached query results for a database."""
+        for key in [k for k in list(self.cache.keys()) if k[0] == database_id]:
+            self.cache.pop(key, None)
+        
+        if self.redis is None:
+            return
+        try:
+            async for redis_key in self.redis.scan_iter(match=f"{NOTION_CACHE_PREFIX}{database_id}:*"):
+                await self.redis.delete(redis_key)
+        except Exception:
+            pass
+    
+    @staticmethod
+    def redis_key(key: tuple) -> str:
+        """Build a Redis key, namespaced by database ID so it can be invalidated."""
+        digest = hashlib.blake2b(json.dumps(key[1:]).encode(), digest_size=16).hexdigest()
+        return f"{NOTION_CACHE_PREFIX}{key[0]}:{digest}"
+    
+    async def redis_get(self, redis_key: str) -> Optional[tuple[float, tuple]]:
+        """
+        Read (expires_at, results) from Redis, with expires_at taken from the
+        key's remaining TTL. Any Redis failure counts as a miss.
+        """
+        if self.redis is None:
+            return None
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.get(redis_key)
+                pipe.pttl(redis_key)
+                raw, ttl_ms = await pipe.execute()
+        except Exception:
+            return None
+        if raw is None or ttl_ms <= 0:
+            return None
+        return (time.monotonic() + ttl_ms / 1000, tuple(json.loads(raw)))
+    
+    async def redis_set(self, redis_key: str, results: tuple) -> None:
+        """Write results to Redis; failures leave only the in-process cache."""
+        if self.redis is None:
+            return
+        try:
+            await self.redis.set(redis_key, json.dumps(results), ex=NOTION_CACHE_TTL)
+        except Exception:
+            pass
+    
+    async def fetch_database(
+        self, 
+        database_id: str, 
+        filter_obj: Optional[dict] = None,
+        sorts: Optional[list] = None,
+        page_size: Optional[int] = None
     ) -> list[dict]:
-        """Query a Notion database with optional filter and sorts."""
-        url = f"{NOTION_BASE_URL}/databases/{database_id}/query"
+        """Query a Notion database directly, bypassing the cache."""
+        url = f"/databases/{database_id}/query"
         
         body = {}
         if filter_obj:
             body["filter"] = filter_obj
         if sorts:
             body["sorts"] = sorts
+        if page_size:
+            body["page_size"] = page_size
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(url, headers=self.headers, json=body)
+        results = []
+        while True:
+            async with self.semaphore:
+                response = await self.client.post(url, json=body)
             
             if response.status_code != 200:
                 raise HTTPException(
@@ -209,7 +404,11 @@ class NotionClient:
                 )
             
             data = response.json()
-            return data.get("results", [])
+            results.extend(data.get("results", []))
+            
+            if page_size or not data.get("has_more") or not data.get("next_cursor"):
+                return results
+            body["start_cursor"] = data["next_cursor"]
     
     async def query_by_date(self, database_id: str, date_property: str, date_value: str) -> list[dict]:
         """Query database where a date property equals a specific date."""
@@ -221,24 +420,178 @@ class NotionClient:
     
     async def query_by_text_equals(self, database_id: str, property_name: str, value: str) -> list[dict]:
         """Query database where a rich_text/title property equals a value."""
-        # Try rich_text first, then title
-        filter_obj = {
-            "or": [
-                {"property": property_name, "rich_text": {"equals": value}},
-                {"property": property_name, "title": {"equals": value}}
-            ]
-        }
-        return await self.query_database(database_id, filter_obj)
+        return await self.query_by_text_in(database_id, property_name, [value])
+    
+    async def query_by_text_in(self, database_id: str, property_name: str, values: list[str]) -> list[dict]:
+        """
+        Query database where a rich_text/title property equals any of the values.
+        Uses one compound "or" filter per batch of values instead of one query per value.
+        """
+        batches = [
+            values[i:i + NOTION_MAX_FILTER_VALUES]
+            for i in range(0, len(values), NOTION_MAX_FILTER_VALUES)
+        ]
+        
+        async def query_batch(batch: list[str]) -> list[dict]:
+            # Try rich_text first, then title
+            filter_obj = {
+                "or": [
+                    condition
+                    for value in batch
+                    for condition in (
+                        {"property": property_name, "rich_text": {"equals": value}},
+                        {"property": property_name, "title": {"equals": value}}
+                    )
+                ]
+            }
+            return await self.query_database(database_id, filter_obj)
+        
+        batch_results = await asyncio.gather(*map(query_batch, batches))
+        return [page for results in batch_results for page in results]
     
-    async def query_unresolved_mistakes(self, database_id: str) -> list[dict]:
-        """Query Mistake Bank where Resolved = false."""
-        filter_obj = {
-            "property": "Resolved",
-            "checkbox": {"equals": False}
-        }
+    async def query_unresolved_mistakes(self, database_id: str, objective_ids: list[str], limit: int = 3) -> list[dict]:
+        """Query Mistake Bank for the newest unresolved mistakes on the given objectives."""
         # Sort by created_time descending (newest first)
         sorts = [{"timestamp": "created_time", "direction": "descending"}]
-        return await self.query_database(database_id, filter_obj, sorts)
+        
+        # Same batch size as query_by_text_in keeps each compound filter
+        # within Notion's size limit
+        batches = [
+            objective_ids[i:i + NOTION_MAX_FILTER_VALUES]
+            for i in range(0, len(objective_ids), NOTION_MAX_FILTER_VALUES)
+        ]
+        
+        async def query_batch(batch: list[str]) -> list[dict]:
+            filter_obj = {
+                "and": [
+                    {"property": "Resolved", "checkbox": {"equals": False}},
+                    {"or": [
+                        {"property": "Objective ID", "rich_text": {"equals": obj_id}}
+                        for obj_id in batch
+                    ]}
+                ]
+            }
+            return await self.query_database(database_id, filter_obj, sorts, page_size=limit)
+        
+        # Each batch returns its newest `limit`; merge them and keep the newest overall
+        batch_results = await asyncio.gather(*map(query_batch, batches))
+        mistakes = [page for results in batch_results for page in results]
+        mistakes.sort(key=lambda page: page.get("created_time", ""), reverse=True)
+        return mistakes[:limit]
+
+
+# ==============================================================================
+# EMAIL FORMATTING
+# ==============================================================================
+
+EMAIL_TEMPLATE = """\
+MD-102 DAILY STUDY BRIEF
+Date: {date}
+Phase: {phase}
+Priority: {priority}
+
+================================
+TODAY'S STUDY SESSIONS
+================================
+SESSION 1 — LEARN (1 hour)
+{session1}
+Resources (IDs/URLs):
+{session1_resources}
+
+SESSION 2 — LAB / PRACTICE (1 hour)
+{session2}
+Resources (IDs/URLs):
+{session2_resources}
+
+================================
+TODAY'S OBJECTIVES
+================================
+{objectives}
+
+================================
+KEY RESOURCES
+================================
+{resources}
+
+================================
+PRACTICE TEST (IF ANY)
+================================
+{practice_test}
+
+================================
+OPEN MISTAKES (IF ANY)
+================================
+{mistakes}
+
+================================
+COMPLETION CHECKLIST
+================================
+[ ] Session 1 Done
+[ ] Session 2 Done"""
+
+
+def format_objective(obj: dict) -> str:
+    """Format one objective as a single line with its non-empty details."""
+    line = f"- {obj['id']} — {obj['objective']}"
+    details = " | ".join(
+        f"{label}: {obj[key]}"
+        for label, key in (("Exam Area", "exam_area"), ("Skill", "skill_group"), ("Priority", "priority"))
+        if obj[key]
+    )
+    return f"{line} ({details})" if details else line
+
+
+def format_objectives(objectives: list[dict]) -> str:
+    """Format the objectives section."""
+    if not objectives:
+        return "(No objectives found)"
+    return "\n".join(format_objective(obj) for obj in objectives)
+
+
+def format_resource(res: dict) -> str:
+    """Format one resource with optional URL and why lines."""
+    entry = f"- {res['id']} — {res['name']} ({res['type']})"
+    if res['url']:
+        entry += f"\n  URL: {res['url']}"
+    if res['why']:
+        entry += f"\n  Why: {res['why']}"
+    return entry
+
+
+def format_resources(resources: list[dict]) -> str:
+    """Format the key resources section."""
+    if not resources:
+        return "(No resources found)"
+    return "\n".join(format_resource(res) for res in resources)
+
+
+def format_practice_test(practice_test: Optional[dict]) -> str:
+    """Format the practice test section."""
+    if not practice_test:
+        return "(No practice test scheduled for today)"
+    entry = f"{practice_test['provider']} — {practice_test['test']}"
+    if practice_test['focus']:
+        entry += f"\nFocus: {practice_test['focus']}"
+    if practice_test['notes']:
+        entry += f"\nNotes: {practice_test['notes']}"
+    return entry
+
+
+def format_mistake(m: dict) -> str:
+    """Format one mistake with optional rule and tip lines."""
+    entry = f"- Mistake: {m['summary']}"
+    if m['rule']:
+        entry += f"\n  Rule: {m['rule']}"
+    if m['tip']:
+        entry += f"\n  Tip: {m['tip']}"
+    return entry
+
+
+def format_mistakes(mistakes: list[dict]) -> str:
+    """Format the open mistakes section."""
+    if not mistakes:
+        return "(No open mistakes for today's objectives)"
+    return "\n".join(format_mistake(m) for m in mistakes)
 
 
 # ==============================================================================
@@ -252,19 +605,56 @@ app = FastAPI(
 )
 
 
+@app.on_event("startup")
+async def startup():
+    """Open a single pooled HTTP client for all Notion calls."""
+    app.state.http = httpx.AsyncClient(
+        base_url=NOTION_BASE_URL,
+        headers={
+            "Authorization": f"Bearer {NOTION_TOKEN}",
+            "Notion-Version": NOTION_API_VERSION,
+            "Content-Type": "application/json"
+        },
+        timeout=30.0,
+        # HTTP/2 lets concurrent queries share one connection
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=20)
+    )
+    app.state.redis = aioredis.from_url(
+        REDIS_URL,
+        socket_timeout=REDIS_TIMEOUT,
+        socket_connect_timeout=REDIS_TIMEOUT
+    ) if REDIS_URL else None
+    # Long-lived so its result cache survives across webhook calls
+    app.state.notion = NotionClient(app.state.http, app.state.redis)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Close the shared HTTP and Redis clients."""
+    await app.state.http.aclose()
+    if app.state.redis is not None:
+        await app.state.redis.aclose()
+
+
+# Health responses are constant, so serialize them once at import time
+HEALTH_CHECK_BODY = json.dumps({"status": "healthy", "service": "md102-study-webhook"}, separators=(",", ":")).encode()
+HEALTH_BODY = json.dumps({"status": "ok"}, separators=(",", ":")).encode()
+
+
 @app.get("/")
 async def health_check():
     """Health check endpoint."""
-    return {"status": "healthy", "service": "md102-study-webhook"}
+    return Response(content=HEALTH_CHECK_BODY, media_type="application/json")
 
 
 @app.get("/health")
 async def health():
     """Alternative health check for some hosting platforms."""
-    return {"status": "ok"}
+    return Response(content=HEALTH_BODY, media_type="application/json")
 
 
-@app.post("/webhook")
+@app.post("/webhook", response_model=WebhookResponse)
 async def generate_study_email(
     request: WebhookRequest,
     x_auth_token: Optional[str] = Header(None, alias="X-AUTH-TOKEN")
@@ -317,16 +707,19 @@ async def generate_study_email(
             content={"error": f"Missing database IDs: {', '.join(missing_dbs)}"}
         )
     
+    # Notion filters and the email use the ISO string form
+    run_date = request.run_date.isoformat()
+    
     # Initialize response debug
-    debug = DebugInfo(date=request.run_date)
+    debug = DebugInfo(date=run_date)
     
     # -------------------------------------------------------------------------
     # 3. QUERY PLAN DATABASE FOR TODAY
     # -------------------------------------------------------------------------
-    notion = NotionClient(NOTION_TOKEN)
+    notion = app.state.notion
     
     try:
-        plan_results = await notion.query_by_date(PLAN_DB_ID, "Date", request.run_date)
+        plan_results = await notion.query_by_date(PLAN_DB_ID, "Date", run_date)
     except HTTPException as e:
         return JSONResponse(status_code=e.status_code, content={"error": e.detail})
     
@@ -335,36 +728,38 @@ async def generate_study_email(
             should_send=False,
             reason="no_plan",
             debug=debug
-        ).model_dump()
+        )
     
     plan = plan_results[0]
     
     # -------------------------------------------------------------------------
     # 4. CHECK IF ALREADY COMPLETED
     # -------------------------------------------------------------------------
-    session1_done = extract_checkbox(get_prop(plan, "Session 1 Done"))
-    session2_done = extract_checkbox(get_prop(plan, "Session 2 Done"))
+    plan_props = props_of(plan)
+    
+    session1_done = extract_checkbox(plan_props.get("Session 1 Done", {}))
+    session2_done = extract_checkbox(plan_props.get("Session 2 Done", {}))
     
     if session1_done and session2_done:
         return WebhookResponse(
             should_send=False,
             reason="completed",
             debug=debug
-        ).model_dump()
+        )
     
     # -------------------------------------------------------------------------
     # 5. EXTRACT PLAN DETAILS
     # -------------------------------------------------------------------------
-    phase = extract_rich_text(get_prop(plan, "Phase"))
-    focus_priority = extract_select(get_prop(plan, "Focus Priority")) or extract_rich_text(get_prop(plan, "Focus Priority"))
+    phase = extract_rich_text(plan_props.get("Phase", {}))
+    focus_priority = extract_select_or_text(plan_props.get("Focus Priority", {}))
     
-    session1_text = extract_rich_text(get_prop(plan, "Session 1 (1 hr) – Learn"))
-    session1_resources_raw = extract_rich_text(get_prop(plan, "Session 1 Resources (IDs/URLs)"))
+    session1_text = extract_rich_text(plan_props.get("Session 1 (1 hr) – Learn", {}))
+    session1_resources_raw = extract_rich_text(plan_props.get("Session 1 Resources (IDs/URLs)", {}))
     
-    session2_text = extract_rich_text(get_prop(plan, "Session 2 (1 hr) – Lab/Practice"))
-    session2_resources_raw = extract_rich_text(get_prop(plan, "Session 2 Resources (IDs/URLs)"))
+    session2_text = extract_rich_text(plan_props.get("Session 2 (1 hr) – Lab/Practice", {}))
+    session2_resources_raw = extract_rich_text(plan_props.get("Session 2 Resources (IDs/URLs)", {}))
     
-    focus_objectives_raw = extract_rich_text(get_prop(plan, "Focus objectives (IDs)"))
+    focus_objectives_raw = extract_rich_text(plan_props.get("Focus objectives (IDs)", {}))
     
     # -------------------------------------------------------------------------
     # 6. PARSE OBJECTIVE IDs
@@ -375,200 +770,121 @@ async def generate_study_email(
     # -------------------------------------------------------------------------
     # 7. FETCH OBJECTIVES
     # -------------------------------------------------------------------------
-    objectives = []
-    for obj_id in objective_ids:
+    async def fetch_objectives() -> list[dict]:
+        if not objective_ids:
+            return []
         try:
-            results = await notion.query_by_text_equals(OBJECTIVES_DB_ID, "Objective ID", obj_id)
-            if results:
-                obj_page = results[0]
-                objectives.append({
-                    "id": obj_id,
-                    "objective": extract_rich_text(get_prop(obj_page, "Objective")),
-                    "exam_area": extract_select(get_prop(obj_page, "Exam Area")) or extract_rich_text(get_prop(obj_page, "Exam Area")),
-                    "skill_group": extract_select(get_prop(obj_page, "Skill Group")) or extract_rich_text(get_prop(obj_page, "Skill Group")),
-                    "priority": extract_select(get_prop(obj_page, "Priority")) or extract_rich_text(get_prop(obj_page, "Priority")),
-                    "primary_resources": extract_rich_text(get_prop(obj_page, "Primary Resources (IDs)"))
-                })
+            objective_pages = await notion.query_by_text_in(OBJECTIVES_DB_ID, "Objective ID", objective_ids)
         except Exception:
-            # If an objective query fails, continue with others
-            pass
+            # If the objectives query fails, continue without them
+            objective_pages = []
+        
+        objectives_by_id = index_pages(objective_pages, "Objective ID")
+        
+        objectives = []
+        for obj_id in objective_ids:
+            obj_page = objectives_by_id.get(obj_id)
+            if not obj_page:
+                continue
+            try:
+                objectives.append({"id": obj_id, **extract_page(obj_page, OBJECTIVE_SCHEMA)})
+            except Exception:
+                # Skip a malformed page, continue with others
+                pass
+        return objectives
     
     # -------------------------------------------------------------------------
-    # 8. BUILD RESOURCE ID SET
+    # 8. BUILD RESOURCE ID SET AND FETCH RESOURCES
     # -------------------------------------------------------------------------
-    resource_ids_raw = session1_resources_raw + ", " + session2_resources_raw
-    for obj in objectives:
-        if obj.get("primary_resources"):
-            resource_ids_raw += ", " + obj["primary_resources"]
-    
-    resource_ids = parse_id_list(resource_ids_raw)
-    debug.resources_count = len(resource_ids)
+    async def fetch_resources(objectives: list[dict]) -> list[dict]:
+        resource_ids_raw = session1_resources_raw + ", " + session2_resources_raw
+        for obj in objectives:
+            if obj.get("primary_resources"):
+                resource_ids_raw += ", " + obj["primary_resources"]
+        
+        resource_ids = parse_id_list(resource_ids_raw)
+        debug.resources_count = len(resource_ids)
+        
+        if not resource_ids:
+            return []
+        try:
+            resource_pages = await notion.query_by_text_in(RESOURCES_DB_ID, "Resource ID", resource_ids)
+        except Exception:
+            resource_pages = []
+        
+        resources_by_id = index_pages(resource_pages, "Resource ID")
+        
+        resources = []
+        for res_id in resource_ids:
+            res_page = resources_by_id.get(res_id)
+            if not res_page:
+                continue
+            try:
+                resources.append({"id": res_id, **extract_page(res_page, RESOURCE_SCHEMA)})
+            except Exception:
+                pass
+        return resources
+    
+    async def fetch_objectives_and_resources() -> tuple[list[dict], list[dict]]:
+        # Resources depend on the objectives' primary resources
+        objectives = await fetch_objectives()
+        return objectives, await fetch_resources(objectives)
     
     # -------------------------------------------------------------------------
-    # 9. FETCH RESOURCES
+    # 9. FETCH PRACTICE TEST FOR TODAY
     # -------------------------------------------------------------------------
-    resources = []
-    for res_id in resource_ids:
+    async def fetch_practice_test() -> Optional[dict]:
         try:
-            results = await notion.query_by_text_equals(RESOURCES_DB_ID, "Resource ID", res_id)
-            if results:
-                res_page = results[0]
-                resources.append({
-                    "id": res_id,
-                    "name": extract_rich_text(get_prop(res_page, "Name")),
-                    "type": extract_select(get_prop(res_page, "Type")) or extract_rich_text(get_prop(res_page, "Type")),
-                    "url": extract_url(get_prop(res_page, "URL")),
-                    "why": extract_rich_text(get_prop(res_page, "Why it matters"))
-                })
+            practice_results = await notion.query_by_date(PRACTICE_DB_ID, "Date", run_date)
+            if not practice_results:
+                return None
+            practice_test = extract_page(practice_results[0], PRACTICE_TEST_SCHEMA)
         except Exception:
-            pass
+            return None
+        debug.practice_test_found = True
+        return practice_test
     
     # -------------------------------------------------------------------------
-    # 10. FETCH PRACTICE TEST FOR TODAY
+    # 10. FETCH UNRESOLVED MISTAKES FOR TODAY'S OBJECTIVES
     # -------------------------------------------------------------------------
-    practice_test = None
-    try:
-        practice_results = await notion.query_by_date(PRACTICE_DB_ID, "Date", request.run_date)
-        if practice_results:
-            pt = practice_results[0]
-            practice_test = {
-                "provider": extract_select(get_prop(pt, "Provider")) or extract_rich_text(get_prop(pt, "Provider")),
-                "test": extract_rich_text(get_prop(pt, "Test")),
-                "focus": extract_rich_text(get_prop(pt, "Primary Focus")),
-                "notes": extract_rich_text(get_prop(pt, "Notes"))
-            }
-            debug.practice_test_found = True
-    except Exception:
-        pass
+    async def fetch_mistakes() -> list[dict]:
+        # Nothing can match an empty objective list, so skip the query
+        if not objective_ids:
+            return []
+        try:
+            # Limit to 3 newest
+            unresolved = await notion.query_unresolved_mistakes(MISTAKES_DB_ID, objective_ids, limit=3)
+            mistakes = [extract_page(m, MISTAKE_SCHEMA) for m in unresolved]
+        except Exception:
+            return []
+        debug.mistakes_found = len(mistakes)
+        return mistakes
     
     # -------------------------------------------------------------------------
-    # 11. FETCH UNRESOLVED MISTAKES FOR TODAY'S OBJECTIVES
+    # 11. RUN INDEPENDENT FETCHES CONCURRENTLY
     # -------------------------------------------------------------------------
-    mistakes = []
-    try:
-        all_mistakes = await notion.query_unresolved_mistakes(MISTAKES_DB_ID)
-        
-        # Filter to those matching today's objective IDs
-        objective_id_set = set(objective_ids)
-        for m in all_mistakes:
-            mistake_obj_id = extract_rich_text(get_prop(m, "Objective ID"))
-            if mistake_obj_id in objective_id_set:
-                mistakes.append({
-                    "objective_id": mistake_obj_id,
-                    "summary": extract_rich_text(get_prop(m, "Mistake Summary")),
-                    "rule": extract_rich_text(get_prop(m, "Correct Rule")),
-                    "tip": extract_rich_text(get_prop(m, "Recognition Tip"))
-                })
-        
-        # Limit to 3 newest
-        mistakes = mistakes[:3]
-        debug.mistakes_found = len(mistakes)
-    except Exception:
-        pass
+    (objectives, resources), practice_test, mistakes = await asyncio.gather(
+        fetch_objectives_and_resources(),
+        fetch_practice_test(),
+        fetch_mistakes()
+    )
     
     # -------------------------------------------------------------------------
     # 12. BUILD EMAIL BODY
     # -------------------------------------------------------------------------
-    body_lines = [
-        "MD-102 DAILY STUDY BRIEF",
-        f"Date: {request.run_date}",
-        f"Phase: {phase}",
-        f"Priority: {focus_priority}",
-        "",
-        "================================",
-        "TODAY'S STUDY SESSIONS",
-        "================================",
-        "SESSION 1 — LEARN (1 hour)",
-        session1_text or "(No details)",
-        "Resources (IDs/URLs):",
-        session1_resources_raw or "(None)",
-        "",
-        "SESSION 2 — LAB / PRACTICE (1 hour)",
-        session2_text or "(No details)",
-        "Resources (IDs/URLs):",
-        session2_resources_raw or "(None)",
-        "",
-        "================================",
-        "TODAY'S OBJECTIVES",
-        "================================",
-    ]
-    
-    if objectives:
-        for obj in objectives:
-            obj_line = f"- {obj['id']} — {obj['objective']}"
-            details = []
-            if obj['exam_area']:
-                details.append(f"Exam Area: {obj['exam_area']}")
-            if obj['skill_group']:
-                details.append(f"Skill: {obj['skill_group']}")
-            if obj['priority']:
-                details.append(f"Priority: {obj['priority']}")
-            if details:
-                obj_line += f" ({' | '.join(details)})"
-            body_lines.append(obj_line)
-    else:
-        body_lines.append("(No objectives found)")
-    
-    body_lines.extend([
-        "",
-        "================================",
-        "KEY RESOURCES",
-        "================================",
-    ])
-    
-    if resources:
-        for res in resources:
-            body_lines.append(f"- {res['id']} — {res['name']} ({res['type']})")
-            if res['url']:
-                body_lines.append(f"  URL: {res['url']}")
-            if res['why']:
-                body_lines.append(f"  Why: {res['why']}")
-    else:
-        body_lines.append("(No resources found)")
-    
-    body_lines.extend([
-        "",
-        "================================",
-        "PRACTICE TEST (IF ANY)",
-        "================================",
-    ])
-    
-    if practice_test:
-        body_lines.append(f"{practice_test['provider']} — {practice_test['test']}")
-        if practice_test['focus']:
-            body_lines.append(f"Focus: {practice_test['focus']}")
-        if practice_test['notes']:
-            body_lines.append(f"Notes: {practice_test['notes']}")
-    else:
-        body_lines.append("(No practice test scheduled for today)")
-    
-    body_lines.extend([
-        "",
-        "================================",
-        "OPEN MISTAKES (IF ANY)",
-        "================================",
-    ])
-    
-    if mistakes:
-        for m in mistakes:
-            body_lines.append(f"- Mistake: {m['summary']}")
-            if m['rule']:
-                body_lines.append(f"  Rule: {m['rule']}")
-            if m['tip']:
-                body_lines.append(f"  Tip: {m['tip']}")
-    else:
-        body_lines.append("(No open mistakes for today's objectives)")
-    
-    body_lines.extend([
-        "",
-        "================================",
-        "COMPLETION CHECKLIST",
-        "================================",
-        "[ ] Session 1 Done",
-        "[ ] Session 2 Done",
-    ])
-    
-    body = "\n".join(body_lines)
+    body = EMAIL_TEMPLATE.format(
+        date=run_date,
+        phase=phase,
+        priority=focus_priority,
+        session1=session1_text or "(No details)",
+        session1_resources=session1_resources_raw or "(None)",
+        session2=session2_text or "(No details)",
+        session2_resources=session2_resources_raw or "(None)",
+        objectives=format_objectives(objectives),
+        resources=format_resources(resources),
+        practice_test=format_practice_test(practice_test),
+        mistakes=format_mistakes(mistakes)
+    )
     
     # -------------------------------------------------------------------------
     # 13. BUILD SUBJECT
@@ -584,7 +900,7 @@ async def generate_study_email(
         body=body,
         reason="ok",
         debug=debug
-    ).model_dump()
+    )
 
 
 # ==============================================================================